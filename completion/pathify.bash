@@ -0,0 +1,10 @@
+# Bash completion for pathify. Source this file from ~/.bashrc, with
+# PATHIFY_HOME set to the folder pathify was installed to. Set
+# PATHIFY_PYTHON to use an interpreter other than python3.
+
+_pathify() {
+    local IFS=$'\n'
+    COMPREPLY=($("${PATHIFY_PYTHON:-python3}" -S "$PATHIFY_HOME/src/complete.py" "${COMP_WORDS[@]:1:COMP_CWORD}"))
+}
+
+complete -o default -F _pathify pathify
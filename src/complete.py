@@ -0,0 +1,58 @@
+# --------------------------------------------------------
+# Shell completion entry point for pathify.
+#
+# Only reads completion.json, which pathify rewrites whenever
+# the record or config changes. Deliberately avoids importing
+# pathify itself so that completion stays fast.
+#
+# Usage: complete.py <words after `pathify`...> <current word>
+# --------------------------------------------------------
+
+import os
+import sys
+import json
+
+completion_path = os.path.join(os.path.dirname(__file__), '..', 'completion.json')
+commands = ['config', 'do', 'undo', 'record', 'repair', 'retarget', 'mirror', 'regenerate', 'help']
+
+
+def get_candidates(words, cache):
+    """ Return completion candidates for the last word in `words` """
+    if len(words) <= 1:
+        return commands
+
+    cmd, prev = words[0], words[-2]
+
+    if cmd == 'help' and len(words) == 2:
+        return commands
+    elif cmd == 'undo':
+        if prev in ('-d', '--destination'):
+            return list(cache['shims'].keys())
+
+        destination = cache['default_destination']
+        for i, word in enumerate(words[:-2]):
+            if word in ('-d', '--destination'):
+                destination = os.path.abspath(words[i + 1])
+
+        return cache['shims'].get(destination, [])
+    elif cmd == 'do' and prev in ('-i', '--interpreter'):
+        return sorted(set(cache['interpreters'].values()))
+    elif cmd == 'config' and prev in ('--set', '--unset'):
+        return cache['options'] + ['INTERPRETER[' + k + ']' for k in sorted(cache['interpreters'])]
+
+    return []
+
+def main(words):
+    try:
+        with open(completion_path, 'r') as f:
+            cache = json.load(f)
+    except (IOError, ValueError):
+        return
+
+    current = words[-1] if words else ''
+    for candidate in get_candidates(words or [''], cache):
+        if candidate.startswith(current):
+            print(candidate)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
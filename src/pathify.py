@@ -1,5 +1,16 @@
 from argparse import ArgumentParser, HelpFormatter
-import configparser, os, sys, utils, re, json, copy
+import configparser, os, sys, utils, re, json, copy, time, hashlib
+from contextlib import contextmanager
+from collections import namedtuple
+
+# fcntl isn't available on Windows, so record_lock() uses msvcrt there instead.
+# Replacing a file that a reader has open can also briefly fail on Windows,
+# which utils.write_file_atomic() retries.
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
 
 # ================================
 # Global variables
@@ -8,6 +19,7 @@ import configparser, os, sys, utils, re, json, copy
 # TODO: Make this work properly cross-platform
 template_filetype = '.bat'
 template_filetypes = ['.bat', '.sh']
+repair_max_depth = 8
 template_replace_string = {
     'target': '<DIRECTORY>',
     'interpreter': '<INTERPRETER> '   # Note the trailing space
@@ -18,6 +30,8 @@ template_path   = os.path.join(os.path.dirname(__file__), '..', 'templates', 'te
 config_path     = os.path.join(os.path.dirname(__file__), '..', 'config.ini')
 helpfile_path   = os.path.join(os.path.dirname(__file__), '..', 'help')
 recordfile_path = os.path.join(os.path.dirname(__file__), '..', 'records.json')
+lockfile_path   = recordfile_path + '.lock'
+completion_path = os.path.join(os.path.dirname(__file__), '..', 'completion.json')
 
 config = configparser.ConfigParser()
 config.read(config_path)
@@ -40,17 +54,27 @@ if not config.get('GENERAL', 'MagicPrompt', fallback=None):
 default_dest = config.get('GENERAL', 'DefaultDestination', fallback=None)
 
 allowed_config = {
-    'GENERAL': ['defaultdestination', 'searchfolders' ,'magicprompt'],
+    'GENERAL': ['defaultdestination', 'searchfolders', 'repairfolders', 'magicprompt', 'metricsfile'],
     'INTERPRETER': []
 }
 
+# Filled in as pathify runs, and written to GENERAL[metricsfile] at the end.
+metrics = {
+    'scan_seconds': {}
+}
+
 # ================================
 # Make sure that records.txt exists
 # ================================
 
+# Another process may be creating it at the same time, so don't
+# clobber a file that appears between the check and the write.
 if not os.path.exists(recordfile_path):
-    with open(recordfile_path, 'w') as f:
-        f.write('{}')
+    try:
+        with open(recordfile_path, 'x') as f:
+            f.write('{}')
+    except FileExistsError:
+        pass
 
 # ================================
 # Commands and helper functions
@@ -111,10 +135,7 @@ def cmd_do(args):
         if interpreter and utils.which(interpreter) is None:
             sys.exit('ERROR: Interpreter "' + interpreter + '" could not be found.')
 
-        # Read in template file and insert target path and interpreter
-        template = get_template(template_filetype)
-        template = template.replace(template_replace_string['target'], target_path)
-        template = template.replace(template_replace_string['interpreter'], interpreter + (' ' if interpreter else ''))
+        template = render_template(target_path, interpreter)
 
         # Check if a file exists at the place we want to save to, and
         # prompt user for confirmation if so.
@@ -166,17 +187,23 @@ def cmd_do(args):
                     config.set('GENERAL', 'DefaultDestination', dest_folder)
 
                 if save_opts['interpreter'] or save_opts['destination']:
-                    with open('config.ini', 'w') as f:
-                        config.write(f)
+                    write_config()
 
     cmd_record()
 
 def cmd_undo(args):
-    files = flatten_record(get_record())
-    files = [os.path.join(elem['destination'], elem['filename']) for elem in files]
-
+    destination = os.path.abspath(args.destination)
     (filename, filetype) = os.path.splitext(args.filename)
-    choice_list = choose_file(args.destination, filename, filetype, files)
+
+    # Only collect candidates from the chosen destination. The name is matched
+    # loosely here, and choose_file() applies the MagicPrompt rules to what's left.
+    files = []
+    for entry in iter_record({destination: get_record().get(destination, {})}):
+        if not filename or os.path.splitext(entry.filename)[0].lower() == filename.lower():
+            files.append(os.path.join(entry.destination, entry.filename))
+
+    # An empty list would make choose_file() offer everything in the folder.
+    choice_list = choose_file(destination, filename, filetype, files) if files else False
 
     if choice_list is None:
         print('Selection cancelled.')
@@ -191,7 +218,7 @@ def cmd_undo(args):
     if len(choice_list) == 1:
         message += choice_list[0][1] + choice_list[0][2] + '?'
     else:
-        message += ' those ' + len(choice_list) + ' choices?'
+        message += 'those ' + str(len(choice_list)) + ' files?'
 
     message += ' [y/n]'
 
@@ -229,6 +256,14 @@ def cmd_record(args=None):
 def cmd_record_update(args=None):
     (added, deleted) = update_record()
     expired = get_expired_files()
+    stale = get_stale_files()
+
+    metrics['changes'] = {
+        'added': added['count'],
+        'deleted': deleted['count'],
+        'expired': expired['count'],
+        'stale': stale['count']
+    }
 
     message = 'Records are up to date.'
 
@@ -240,12 +275,20 @@ def cmd_record_update(args=None):
         deleted_plural = 'item was' if deleted['count'] == 1 else 'items were'
         message += '\n  ' + str(deleted['count']) + ' ' + deleted_plural + ' removed [-]'
 
+    if stale['count']:
+        stale_plural = 'item uses' if stale['count'] == 1 else 'items use'
+        message += '\n  ' + str(stale['count']) + ' ' + stale_plural + ' an outdated template [~]'
+
     if expired['count']:
         expired_plural = 'item is' if expired['count'] == 1 else 'items are'
         message += '\n  ' + str(expired['count']) + ' ' + expired_plural + ' invalid [!]\n\n'
         message += 'To fix an invalid file, either replace its target executable\n'
         message += 'or re-pathify it with a valid target.'
 
+    if stale['count']:
+        message += '\n\nTo update files with an outdated template, run\n'
+        message += '`pathify regenerate --stale`.'
+
     print(message)
 
     return (added, deleted, expired)
@@ -266,28 +309,36 @@ def cmd_record_ls(args=None, added=None, deleted=None, expired=None):
     else:
         print() # Padding from the above line.
 
+    # Map each (filename, source) pair to its status, grouped by destination,
+    # so that each destination only has to look at its own entries.
+    statuses = {}
+    for status, changes in [('[!]', expired), ('[-]', deleted), ('[+]', added)]:
+        for entry in changes['list']:
+            statuses.setdefault(entry.destination, {})[(entry.filename, entry.source)] = status
+
     # Make sure to include destinations even if they contain
     # deleted items but nothing else.
-    for val in deleted['list']:
-        if val['destination'] not in records.keys():
-            records[val['destination']] = {}
+    destinations = set(records.keys()) | set(entry.destination for entry in deleted['list'])
 
-    for destination, values in sorted(records.items()):
-        print(destination + ':')
+    mirrors = dict((local, shared) for (shared, local) in get_mirrors())
+
+    for destination in sorted(destinations):
+        if destination in mirrors:
+            print(destination + ' (mirror of ' + mirrors[destination] + '):')
+        else:
+            print(destination + ':')
         file_list = ''
 
-        # Get the files that were added or deleted from the current dest folder.
-        added_files   = [(i['filename'], i['source']) for i in added['list'] if i['destination'] == destination]
-        deleted_files = [(i['filename'], i['source']) for i in deleted['list'] if i['destination'] == destination]
-        expired_files = [(i['filename'], i['source']) for i in expired['list'] if i['destination'] == destination]
+        dest_statuses = statuses.get(destination, {})
+        values = {k:v['source'] for (k, v) in records.get(destination, {}).items()}
+        stale_files = set(k for (k, v) in records.get(destination, {}).items() if is_template_stale(k, v))
 
-        # This bit of shenanigans is to get the dictionary key-value pairs
-        # AND the deleted files into the same data structure so we can see what
-        # was removed.
-        if deleted_files:
-            values = list(values.items())
-            values.extend(deleted_files)
-            values = dict(values)
+        # Get the deleted files into the same data structure as the
+        # recorded ones so we can see what was removed.
+        if deleted['count']:
+            for (filename, source), status in dest_statuses.items():
+                if status == '[-]':
+                    values[filename] = source
 
         # Format things nicely. " status filename  => source"
         column_width = len(max(values.keys(), key=len))
@@ -295,19 +346,374 @@ def cmd_record_ls(args=None, added=None, deleted=None, expired=None):
 
         # Iterate over everything and build a nice output string.
         for filename, source in sorted(values.items()):
-            if (filename, source) in added_files:
-                status = '[+]'
-            elif (filename, source) in deleted_files:
-                status = '[-]'
-            elif (filename, source) in expired_files:
-                status = '[!]'
-            else:
-                status = ''
+            status = dest_statuses.get((filename, source), '')
+
+            if not status and filename in stale_files:
+                status = '[~]'
 
             file_list += format_string.format(status, filename, source)
 
         print(file_list)
 
+def cmd_regenerate(args):
+    # Make sure the record knows about every file's current template first.
+    update_record()
+
+    regenerated = []
+    skipped = []
+    updated = []
+
+    for entry in iter_record(get_record()):
+        if args.stale and not is_template_stale(entry.filename, entry.info):
+            continue
+
+        path = os.path.join(entry.destination, entry.filename)
+        interpreter = entry.info.get('interpreter')
+
+        # Entries recorded before the interpreter was tracked get another try.
+        if interpreter is None:
+            with open(path, 'r') as f:
+                interpreter = find_shim_interpreter(f.read(), os.path.splitext(path)[1])
+
+        # Only guess the interpreter when asked to, since a wrong guess changes
+        # how the target is run.
+        if interpreter is None and args.default_interpreter:
+            interpreter = config.get('INTERPRETER', os.path.splitext(entry.source)[1], fallback='')
+
+        if interpreter is None:
+            skipped.append(entry)
+            continue
+
+        utils.write_file_atomic(path, render_template(entry.source, interpreter))
+
+        updated.append((entry, {
+            'interpreter': interpreter,
+            'template': get_template_hash(os.path.splitext(entry.filename)[1]),
+            'shim': get_shim_fingerprint(path)
+        }))
+        regenerated.append(entry)
+
+    commit_record_changes([], [], updated)
+
+    message = 'Regenerated ' + str(len(regenerated)) + ' item' + ('' if len(regenerated) == 1 else 's') + '.'
+
+    if skipped:
+        message += '\n\nSkipped ' + str(len(skipped)) + ' whose interpreter could not be read. Re-pathify these by hand,\n'
+        message += 'or pass --default-interpreter to use INTERPRETER[<filetype>] for them (or none if unset):'
+
+        for entry in skipped:
+            message += '\n  ' + os.path.join(entry.destination, entry.filename) + '  => ' + entry.source
+
+    print(message)
+
+def cmd_repair(args=None):
+    expired = get_expired_files()
+
+    if not expired['count']:
+        print('Nothing to repair.')
+        return
+
+    # Group expired entries by the file their target used to be.
+    # Several pathified files may point at the same target.
+    wanted = {}
+    for entry in expired['list']:
+        if 'stat' in entry.info:
+            (dev, ino, size) = entry.info['stat']
+            wanted.setdefault((dev, ino), []).append(entry)
+
+    repair_folders = config.get('GENERAL', 'RepairFolders', fallback=None)
+
+    if not repair_folders:
+        sys.exit('ERROR: No folders to search. Set GENERAL[repairfolders] to the folders targets may have moved to.')
+
+    repair_folders = repair_folders.replace('\n', '').split(',')
+    found = find_moved_targets(repair_folders, wanted.keys())
+
+    repaired = []
+    unreadable = []
+
+    for key, path in found.items():
+        for entry in wanted[key]:
+            # Inode numbers get reused, so make sure it's still the same file.
+            if get_target_stat(path) != entry.info['stat']:
+                continue
+
+            # The pathified file may have been removed or edited since the last scan.
+            try:
+                if retarget_file(os.path.join(entry.destination, entry.filename), path):
+                    repaired.append((entry, path))
+                    continue
+            except OSError:
+                pass
+
+            unreadable.append((entry, path))
+
+    if repaired:
+        with edit_record() as records:
+            for (entry, path) in repaired:
+                info = records.get(entry.destination, {}).get(entry.filename)
+
+                if info:
+                    info['source'] = path
+
+    message = 'Repaired ' + str(len(repaired)) + ' of ' + str(expired['count']) + ' invalid items.'
+
+    for (entry, path) in repaired:
+        message += '\n  ' + os.path.join(entry.destination, entry.filename) + '  => ' + path
+
+    if unreadable:
+        message += '\n\nSkipped ' + str(len(unreadable)) + ' that are missing or could not be read.'
+        message += ' Run `pathify record` and try again:'
+
+        for (entry, path) in unreadable:
+            message += '\n  ' + os.path.join(entry.destination, entry.filename) + '  => ' + path
+
+    print(message)
+
+def cmd_retarget(args):
+    old_prefix = os.path.abspath(args.old_prefix)
+    new_prefix = os.path.abspath(args.new_prefix)
+
+    # Match whole path components, so that /opt/X-1.2 doesn't also match /opt/X-1.23.
+    plan = []
+    for entry in iter_record(get_record()):
+        if entry.source == old_prefix or entry.source.startswith(old_prefix + os.sep):
+            plan.append((entry, new_prefix + entry.source[len(old_prefix):]))
+
+    if not plan:
+        print('No pathified files point inside "' + old_prefix + '".')
+        return
+
+    existing = find_existing_files(path for (entry, path) in plan)
+    missing = [(entry, path) for (entry, path) in plan if path not in existing]
+    plan = [(entry, path) for (entry, path) in plan if path in existing]
+
+    # The plan comes from the record, so a pathified file may have been removed
+    # or edited since. Those are skipped rather than recorded as retargeted.
+    unreadable = []
+
+    if not args.dry_run:
+        rewritten = []
+
+        for (entry, path) in plan:
+            try:
+                if retarget_file(os.path.join(entry.destination, entry.filename), path):
+                    rewritten.append((entry, path, make_record_info(path)))
+                    continue
+            except OSError:
+                pass
+
+            unreadable.append((entry, path))
+
+        plan = [(entry, path) for (entry, path, info) in rewritten]
+
+        if rewritten:
+            with edit_record() as records:
+                for (entry, path, new_info) in rewritten:
+                    info = records.get(entry.destination, {}).get(entry.filename)
+
+                    if info:
+                        info.update(new_info)
+
+    message = ('Would retarget ' if args.dry_run else 'Retargeted ') + str(len(plan)) + ' item'
+    message += '' if len(plan) == 1 else 's'
+    message += ':' if plan else '.'
+
+    for (entry, path) in plan:
+        message += '\n  ' + os.path.join(entry.destination, entry.filename) + '  => ' + path
+
+    if missing:
+        message += '\n\nSkipped ' + str(len(missing)) + ' with no matching target:'
+
+        for (entry, path) in missing:
+            message += '\n  ' + os.path.join(entry.destination, entry.filename) + '  => ' + path
+
+    if unreadable:
+        message += '\n\nSkipped ' + str(len(unreadable)) + ' that are missing or could not be read.'
+        message += ' Run `pathify record` and try again:'
+
+        for (entry, path) in unreadable:
+            message += '\n  ' + os.path.join(entry.destination, entry.filename) + '  => ' + path
+
+    print(message)
+
+def cmd_mirror(args):
+    mirrors = get_mirrors()
+
+    if args.stop and not args.local:
+        sys.exit('ERROR: --stop must be used together with --to.')
+
+    if args.local:
+        local = os.path.abspath(args.local)
+
+        if args.stop:
+            if local not in [pair[1] for pair in mirrors]:
+                sys.exit('ERROR: "' + local + '" is not a mirror.')
+
+            set_mirrors([pair for pair in mirrors if pair[1] != local])
+            print('Stopped mirroring to "' + local + '". Files already copied there were left in place.')
+            return
+
+    if args.shared:
+        if not args.local:
+            sys.exit('ERROR: --from must be used together with --to.')
+
+        shared = os.path.abspath(args.shared)
+
+        for folder in (shared, local):
+            if not os.path.isdir(folder):
+                sys.exit('ERROR: The folder "' + folder + '" could not be found.')
+        if shared == local:
+            sys.exit('ERROR: A folder cannot mirror itself.')
+
+        # Each local folder mirrors exactly one shared folder.
+        if (shared, local) not in mirrors:
+            mirrors = [pair for pair in mirrors if pair[1] != local] + [(shared, local)]
+            set_mirrors(mirrors)
+
+        mirrors = [(shared, local)]
+    elif args.local:
+        mirrors = [pair for pair in mirrors if pair[1] == local]
+
+        if not mirrors:
+            sys.exit('ERROR: "' + local + '" is not a mirror. Use --from to set one up.')
+
+    if not mirrors:
+        sys.exit('ERROR: No mirrors have been set up. Use `pathify mirror --from <shared> --to <local>`.')
+
+    for (shared, local) in mirrors:
+        (copied, removed) = sync_mirror(shared, local)
+
+        message = local + ' (mirror of ' + shared + '): '
+        message += str(len(copied)) + ' copied, ' + str(len(removed)) + ' removed.'
+        print(message)
+
+# Brings `local` up to date with `shared`, copying only the pathified files whose
+# fingerprint differs. Returns lists of the copied and removed entries.
+def sync_mirror(shared, local):
+    # Refresh both sides first, so that the fingerprints are current.
+    records = get_record()
+    for folder in (shared, local):
+        commit_record_changes(*scan_destination(folder, records.get(folder, {})))
+
+    records = get_record()
+    shared_files = records.get(shared, {})
+    local_files = records.get(local, {})
+
+    copied = []
+    removed = []
+
+    for filename, info in shared_files.items():
+        local_info = local_files.get(filename, {})
+        digest = info.get('shim', [None] * 3)[2]
+
+        if digest and local_info.get('mirror_of') == shared and local_info.get('shim', [None] * 3)[2] == digest:
+            continue
+
+        with open(os.path.join(shared, filename), 'rb') as f:
+            content = f.read()
+
+        local_path = os.path.join(local, filename)
+        utils.write_file_atomic(local_path, content)
+
+        local_info = dict(info)
+        local_info['shim'] = get_shim_fingerprint(local_path)
+        local_info['mirror_of'] = shared
+        copied.append(RecordEntry(local, filename, info['source'], local_info))
+
+    # Only remove files that were copied from this shared folder.
+    for entry in iter_record({local: local_files}):
+        if entry.info.get('mirror_of') == shared and entry.filename not in shared_files:
+            try:
+                os.remove(os.path.join(local, entry.filename))
+            except FileNotFoundError:
+                pass
+
+            removed.append(entry)
+
+    commit_record_changes(copied, removed)
+
+    return (copied, removed)
+
+# Mirrors are saved in GENERAL[mirrors] as comma-separated `shared>local` pairs.
+def get_mirrors():
+    mirrors = config.get('GENERAL', 'Mirrors', fallback='')
+    pairs = []
+
+    for pair in mirrors.replace('\n', '').split(','):
+        if '>' in pair:
+            pairs.append(tuple(pair.split('>', 1)))
+
+    return pairs
+
+def set_mirrors(pairs):
+    if pairs:
+        config.set('GENERAL', 'Mirrors', ','.join(shared + '>' + local for (shared, local) in pairs))
+    else:
+        config.remove_option('GENERAL', 'Mirrors')
+
+    write_config()
+
+# Returns the subset of the given paths that are existing files. Paths are
+# grouped by folder so that each folder is only listed once.
+def find_existing_files(paths):
+    folders = {}
+    for path in paths:
+        folders.setdefault(os.path.dirname(path), []).append(path)
+
+    existing = set()
+    for folder, folder_paths in folders.items():
+        try:
+            names = set(entry.name for entry in os.scandir(folder) if entry.is_file())
+        except OSError:
+            continue
+
+        if not filesystem_case_sensitive:
+            names = set(name.lower() for name in names)
+
+        for path in folder_paths:
+            name = os.path.basename(path)
+
+            if (name if filesystem_case_sensitive else name.lower()) in names:
+                existing.add(path)
+
+    return existing
+
+# Walks the given folders once, looking for files whose (st_dev, st_ino) is in `wanted`.
+# Returns a dict mapping each key that was found to the file's new path.
+def find_moved_targets(folders, wanted):
+    wanted = set(wanted)
+    wanted_inodes = set(ino for (dev, ino) in wanted)
+    found = {}
+    stack = [(os.path.abspath(folder), 0) for folder in folders]
+
+    while stack and len(found) < len(wanted):
+        (folder, depth) = stack.pop()
+
+        try:
+            entries = list(os.scandir(folder))
+        except OSError:
+            continue
+
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    if depth < repair_max_depth:
+                        stack.append((entry.path, depth + 1))
+                    continue
+
+                # inode() is free on most systems, so check it before doing a full stat.
+                if entry.is_file() and entry.inode() in wanted_inodes:
+                    stat = os.stat(entry.path)
+                    key = (stat.st_dev, stat.st_ino)
+
+                    if key in wanted and key not in found:
+                        found[key] = entry.path
+            except OSError:
+                continue
+
+    return found
+
 def cmd_config(args):
     if args.print_config or (not args.set_option and not args.unset_option):
         with open(config_path, 'r') as f:
@@ -359,7 +765,7 @@ def cmd_config(args):
 
         # Sanitization
         if section == 'GENERAL':
-            if option in ['defaultdestination', 'searchfolders']:
+            if option in ['defaultdestination', 'searchfolders', 'repairfolders']:
                 folders = value.split(',')
 
                 for i, folder in enumerate(folders):
@@ -373,6 +779,11 @@ def cmd_config(args):
                 value = ','.join(folders)
 
                 # TODO: check if folder is in system PATH and prompt to add it
+            elif option == 'metricsfile':
+                if not os.path.isabs(value):
+                    sys.exit('ERROR: Specified path "' + value + '" is not an absolute reference.')
+                if not os.path.isdir(os.path.dirname(value)):
+                    sys.exit('ERROR: The folder for "' + value + '" does not exist.')
             elif option == 'magicprompt':
                 if value.lower() not in ['true', 'false']:
                     sys.exit("ERROR: Disallowed value. GENERAL[magicprompt] must be 'true' or 'false'.")
@@ -387,8 +798,7 @@ def cmd_config(args):
         config.set(section, option, value)
 
     # Save changes to file
-    with open('config.ini', 'w') as f:
-        config.write(f)
+    write_config()
 
     if args.set_option:
         print('Option set succesfully.')
@@ -417,8 +827,7 @@ def choose_file(target_folder, filename='', filetype='', files=[]):
 
     magic_prompt = config.getboolean('GENERAL', 'MagicPrompt', fallback=False)
 
-    for i, elem in enumerate(files):
-        files[i] = os.path.splitext(elem)
+    files = [os.path.splitext(elem) for elem in files]
 
     # Get all files whose base name is the same as the target. If
     # magic_prompt is true then the comparison will only be case-sensitive
@@ -456,15 +865,14 @@ def choose_file(target_folder, filename='', filetype='', files=[]):
 
             path_dict[dirname].append(filename)
 
-        # Build the prompt message
+        # Build the menu. The prompt only prints the page being looked at.
         counter = 0
         options = {}
+        menu = []
         for key, value in sorted(path_dict.items()):
-            message += '\n\n' + key + ':'
-
             for path in sorted(value):
                 counter += 1
-                message += '\n  ' + str(counter) + ':  ' + path
+                menu.append((str(counter), path, key))
 
                 (filename, filetype) = os.path.splitext(path)
                 options[str(counter)] = (key, filename, filetype)
@@ -473,7 +881,8 @@ def choose_file(target_folder, filename='', filetype='', files=[]):
         try:
             prompt_options = {
                 'catch_interrupt': False,
-                'list_delimiter': ','
+                'list_delimiter': ',',
+                'menu': menu
             }
             result = utils.prompt(message, options, prompt_options)
         except KeyboardInterrupt:
@@ -486,20 +895,35 @@ def choose_file(target_folder, filename='', filetype='', files=[]):
     # If the user selected multiple choices the result will be a list of tuples.
     return result
 
-def delete_record_entry(filename, destination):
-    records = get_record()
-
+def delete_record_entry(records, filename, destination):
     if destination in records.keys() and filename in records[destination].keys():
         del(records[destination][filename])
 
-    if len(records[destination].keys()) == 0:
-        del(records[destination])
-
-    write_record(records)
+        if len(records[destination].keys()) == 0:
+            del(records[destination])
 
 def get_record(filename=None, source=None, destination=None):
+    start_time = time.perf_counter()
+
+    # The record file is only ever replaced, never written in place, so
+    # reading doesn't need the lock. Whatever file we open is a complete
+    # snapshot, even if a writer replaces it while we read.
     with open(recordfile_path, 'r') as f:
-        records = json.load(f)
+        # A brand new record file may not have had '{}' written to it yet.
+        metrics['record_size_bytes'] = os.fstat(f.fileno()).st_size
+
+        if metrics['record_size_bytes'] == 0:
+            records = {}
+        else:
+            records = json.load(f)
+
+    metrics['record_load_seconds'] = time.perf_counter() - start_time
+
+    # Older records map filenames straight to their source path.
+    for value in records.values():
+        for k, v in value.items():
+            if not isinstance(v, dict):
+                value[k] = {'source': v}
 
     if records:
         if destination:
@@ -510,28 +934,24 @@ def get_record(filename=None, source=None, destination=None):
                 records[key] = {k:v for (k, v) in value.items() if k == filename}
 
             if source:
-                records[key] = {k:v for (k, v) in value.items() if v == source}
+                records[key] = {k:v for (k, v) in value.items() if v['source'] == source}
 
         records = {k:v for (k, v) in records.items() if len(v)}
 
     return records
 
-def flatten_record(records):
-    flat_record = []
+# A single shim in the record. Kept as a named tuple so that iterating
+# over large records doesn't allocate a dict per entry. `info` is the
+# raw record value, which holds the source along with any metadata.
+RecordEntry = namedtuple('RecordEntry', ['destination', 'filename', 'source', 'info'])
 
+# Yields a RecordEntry for every shim in the record, one destination at a time.
+def iter_record(records):
     for destination, contents in records.items():
-        for filename, source in contents.items():
-            flat_record.append({
-                'destination': destination,
-                'filename': filename,
-                'source': source
-            })
-
-    return flat_record
-
-def add_record_entry(filename, source, destination):
-    records = get_record()
+        for filename, info in contents.items():
+            yield RecordEntry(destination, filename, info['source'], info)
 
+def add_record_entry(records, filename, info, destination):
     if destination not in records.keys():
         records[destination] = {}
 
@@ -542,107 +962,492 @@ def add_record_entry(filename, source, destination):
             if filename.lower() == name.lower():
                 del records[destination][name]
 
-    records[destination][filename] = source
-    write_record(records)
+    records[destination][filename] = info
+
+# Builds the record value for a pathified file pointing at `source`.
+def make_record_info(source):
+    info = {'source': source}
 
+    # Remember which file the target was, so that it can be found again if moved.
+    target_stat = get_target_stat(source)
+    if target_stat:
+        info['stat'] = target_stat
+
+    return info
+
+# Returns [st_dev, st_ino, st_size] for the given path, or None if it doesn't exist.
+def get_target_stat(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+
+    return [stat.st_dev, stat.st_ino, stat.st_size]
+
+# Only call this while holding record_lock(), or use edit_record() instead.
 def write_record(records):
-    with open(recordfile_path, 'w') as f:
-        json.dump(records, f)
+    utils.write_file_atomic(recordfile_path, json.dumps(records))
+    write_completion_cache(records)
+
+# Serializes writers across processes. Keep the critical section short:
+# do any scanning beforehand and only apply the results while locked.
+@contextmanager
+def record_lock():
+    with open(lockfile_path, 'a') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        else:
+            # Lock the first byte. LK_LOCK gives up after about ten seconds,
+            # so keep trying for as long as another writer holds it.
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    continue
+
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+# Loads the latest record under the lock and writes it back on exit, so
+# that concurrent pathify processes don't lose each other's changes.
+@contextmanager
+def edit_record():
+    with record_lock():
+        records = get_record()
+        yield records
+        write_record(records)
+
+def write_config():
+    with open(config_path, 'w') as f:
+        config.write(f)
+
+    write_completion_cache(get_record())
+
+# Saves everything that shell completion needs into a single small file,
+# so that complete.py never has to parse the config or the record itself.
+def write_completion_cache(records):
+    shims = {}
+    for entry in iter_record(records):
+        shims.setdefault(entry.destination, []).append(os.path.splitext(entry.filename)[0])
+
+    cache = {
+        'default_destination': config.get('GENERAL', 'DefaultDestination', fallback=None),
+        'shims': {k:sorted(v) for (k, v) in shims.items()},
+        'interpreters': dict(config.items('INTERPRETER')),
+        'options': allowed_config['GENERAL']
+    }
+
+    utils.write_file_atomic(completion_path, json.dumps(cache))
 
 def update_record():
+    start_time = time.perf_counter()
     records = get_record()
-    record_copy = copy.deepcopy(records)
+
+    added = { 'count': 0, 'list': [] }
+    deleted = { 'count': 0, 'list': [] }
+    updated = []
+
+    # Everything up to the final commit works from the snapshot loaded above,
+    # so that the record is only locked while the results are written.
+    for destination in get_tracked_folders(records):
+        destination_start_time = time.perf_counter()
+        changes = scan_destination(destination, records.get(destination, {}))
+
+        added['list'].extend(changes[0])
+        deleted['list'].extend(changes[1])
+        updated.extend(changes[2])
+
+        metrics['scan_seconds'][destination] = time.perf_counter() - destination_start_time
+
+    added['count'] = len(added['list'])
+    deleted['count'] = len(deleted['list'])
+
+    commit_record_changes(added['list'], deleted['list'], updated)
+
+    metrics['update_seconds'] = time.perf_counter() - start_time
+
+    # Return a summary of what's changed.
+    return (added, deleted)
+
+# By default we check all folders that already contain a
+# pathified file, as well as any of the search_folders.
+def get_tracked_folders(records):
+    destinations = list(records.keys())
 
     # Get a list of folders to track based on config settings.
     search_folders = config.get('GENERAL', 'SearchFolders', fallback=None)
 
     if search_folders:
         search_folders = search_folders.replace('\n', '').split(',')
-        search_folders.append(default_dest)
+
+        if default_dest:
+            search_folders.append(default_dest)
 
         # Include tracked folders in the search.
         for folder in search_folders:
-            if folder not in record_copy.keys():
-                record_copy[folder] = {}
+            if folder not in destinations:
+                destinations.append(folder)
+
+    # Mirrors are tracked like any other destination.
+    for pair in get_mirrors():
+        for folder in pair:
+            if folder not in destinations:
+                destinations.append(folder)
+
+    return destinations
+
+# Compares a single destination folder against `known`, its part of the record.
+# Returns lists of added entries, deleted entries, and (entry, stat) pairs for
+# entries that are missing stat information.
+def scan_destination(destination, known):
+    added = []
+    deleted = []
+    updated = []
+
+    files = {}
+    for entry in os.scandir(destination):
+        if os.path.splitext(entry.name)[1] in template_filetypes:
+            files[entry.name] = entry
+
+    # Detect added files that match the pathify template.
+    for name, file_entry in files.items():
+        if name in known.keys():
+            continue
 
-    record_copy_keys = list(record_copy.keys())
+        path = os.path.join(destination, name)
+        shim_info = read_shim_info(path)
 
-    added = { 'count': 0, 'list': [] }
-    deleted = { 'count': 0, 'list': [] }
+        if shim_info is not None:
+            info = make_record_info(shim_info['source'])
+            info.update(shim_info)
+            added.append(RecordEntry(destination, name, info['source'], info))
 
-    # Detect added files that match the pathify template.
-    # By default we check all folders that already contain a
-    # pathified file, as well as any of the search_folders.
-    for destination in record_copy_keys:
-        files = os.listdir(destination)
-        files = [os.path.join(destination, elem) for elem in files if os.path.splitext(elem)[1] in template_filetypes]
-
-        for filepath in files:
-            with open(filepath, 'r') as f:
-                (filename, filetype) = os.path.splitext(os.path.basename(filepath))
-                watermark = get_template_watermark(filetype)
-                file_content = f.read()
-
-                if destination in records and filename + filetype in records[destination].keys():
-                    continue
+    if not filesystem_case_sensitive:
+        files = {k.lower():v for (k, v) in files.items()}
 
-                if file_content.startswith(watermark):
-                    template = get_template(filetype)
+    for entry in iter_record({destination: known}):
+        # Detect files that were removed.
+        # Note that the filename already includes the filetype.
+        file_entry = files.get(entry.filename if filesystem_case_sensitive else entry.filename.lower())
 
-                    # Get the text leading up to the directory in the template, and use this
-                    # to reverse-engineer the template.
-                    match = re.search(r"^(.+)<DIRECTORY>$", template, re.MULTILINE).group(1)
-                    source = re.search(r"^" + match + r"(.+)$", file_content, re.MULTILINE).group(1)
+        if file_entry is None:
+            deleted.append(entry)
+            continue
 
-                    add_record_entry(filename + filetype, source, destination)
+        fields = {}
 
-                    added['list'].append({
-                        'destination': destination,
-                        'filename': filename + filetype,
-                        'source': source
-                    })
+        # Keep the target's stat information current while it still exists, so
+        # that `pathify repair` can find it later even if it changed in place.
+        target_stat = get_target_stat(entry.source)
 
-                    added['count'] += 1
+        if target_stat and target_stat != entry.info.get('stat'):
+            fields['stat'] = target_stat
 
-    # Detect files that were removed.
-    for destination, values in record_copy.items():
-        for filename, source in values.items():
-            path = os.path.join(destination, filename)
+        # Only re-read files whose size or modification time has changed,
+        # or that were recorded before templates were tracked.
+        stat = file_entry.stat()
+        fingerprint = entry.info.get('shim')
 
-            if not os.path.exists(path):
-                delete_record_entry(filename, destination)
+        if not fingerprint or fingerprint[0:2] != [stat.st_mtime_ns, stat.st_size] or 'template' not in entry.info:
+            shim_info = read_shim_info(os.path.join(destination, entry.filename))
 
-                deleted['list'].append({
-                    'destination': destination,
-                    'filename': filename, # Note that this already includes the filetype.
-                    'source': source
-                })
+            if shim_info is not None:
+                # The file may have been overwritten to point somewhere else.
+                if shim_info['source'] != entry.source:
+                    fields.update(make_record_info(shim_info['source']))
 
-                deleted['count'] += 1
+                fields.update(shim_info)
+            else:
+                # Still record the fingerprint, so that an unreadable file isn't
+                # re-read on every scan. It counts as using an outdated template.
+                fields['shim'] = get_shim_fingerprint(os.path.join(destination, entry.filename))
+                fields['template'] = None
 
-    # Return a summary of what's changed.
-    return (added, deleted)
+        if fields:
+            updated.append((entry, fields))
+
+    return (added, deleted, updated)
+
+# Returns the record fields describing a pathified file itself, or None if it
+# isn't one. 'template' is the hash of the template it was generated from, or
+# None if it doesn't match the current template. 'interpreter' is None if it
+# couldn't be read back out of the file.
+def read_shim_info(path):
+    with open(path, 'r') as f:
+        file_content = f.read()
+
+    filetype = os.path.splitext(path)[1]
+
+    if not file_content.startswith(get_template_watermark(filetype)):
+        return None
+
+    match = find_shim_target(file_content, filetype)
+
+    if not match:
+        return None
+
+    source = match.group(2)
+    interpreter = find_shim_interpreter(file_content, filetype)
+    template_hash = None
+
+    if interpreter is not None and render_template(source, interpreter) == file_content:
+        template_hash = get_template_hash(filetype)
+
+    return {
+        'source': source,
+        'interpreter': interpreter,
+        'template': template_hash,
+        'shim': get_shim_fingerprint(path)
+    }
+
+# Returns True if the pathified file wasn't generated from the current template.
+def is_template_stale(filename, info):
+    return info.get('template') != get_template_hash(os.path.splitext(filename)[1])
+
+# Returns [st_mtime_ns, st_size, sha1] for a pathified file. The hash identifies
+# its contents, and the stat values let scans skip re-reading unchanged files.
+def get_shim_fingerprint(path):
+    with open(path, 'rb') as f:
+        stat = os.fstat(f.fileno())
+        digest = hashlib.sha1(f.read()).hexdigest()
+
+    return [stat.st_mtime_ns, stat.st_size, digest]
+
+# `updated` is a list of (entry, fields) pairs, where fields are merged into
+# the entry's record value.
+def commit_record_changes(added, deleted, updated=[]):
+    if not (added or deleted or updated):
+        return
+
+    with edit_record() as current:
+        for entry in added:
+            add_record_entry(current, entry.filename, entry.info, entry.destination)
+
+        for entry in deleted:
+            delete_record_entry(current, entry.filename, entry.destination)
+
+        # Another process may have changed these entries since our snapshot.
+        for (entry, fields) in updated:
+            info = current.get(entry.destination, {}).get(entry.filename)
+
+            if info and info['source'] == entry.source:
+                info.update(fields)
 
 def get_expired_files():
-    records = flatten_record(get_record())
+    start_time = time.perf_counter()
     expired = {
         'count': 0,
         'list': []
     }
 
-    for record in records:
-        if not os.path.exists(record['source']):
-            expired['count'] += 1
-            expired['list'].append(record)
+    for destination, contents in get_record().items():
+        expired['list'].extend(get_expired_entries(destination, contents))
+
+    expired['count'] = len(expired['list'])
+    metrics['expired_seconds'] = time.perf_counter() - start_time
 
     return expired
 
-def get_template(filetype):
-    with open(template_path, 'r') as f:
-        template = get_template_watermark(template_filetype) + f.read()
+def get_stale_files():
+    stale = {
+        'count': 0,
+        'list': []
+    }
+
+    for entry in iter_record(get_record()):
+        if is_template_stale(entry.filename, entry.info):
+            stale['count'] += 1
+            stale['list'].append(entry)
+
+    return stale
+
+def get_expired_entries(destination, contents):
+    return [entry for entry in iter_record({destination: contents}) if not os.path.exists(entry.source)]
+
+# Writes the collected metrics to GENERAL[metricsfile], if set. Files ending
+# in .prom are written for node_exporter's textfile collector, anything else as JSON.
+def write_metrics(command):
+    metrics_path = config.get('GENERAL', 'MetricsFile', fallback=None)
+
+    if not metrics_path:
+        return
+
+    stats = dict(metrics)
+    stats['command'] = command
+    stats['timestamp'] = time.time()
+    stats['entries'] = {k:len(v) for (k, v) in get_record().items()}
+
+    if metrics_path.endswith('.prom'):
+        content = format_prometheus_metrics(stats)
+    else:
+        content = json.dumps(stats, indent=2, sort_keys=True) + '\n'
+
+    utils.write_file_atomic(metrics_path, content)
+
+def format_prometheus_metrics(stats):
+    def escape(value):
+        return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    def metric(name, help_text, samples):
+        lines = ['# HELP pathify_' + name + ' ' + help_text, '# TYPE pathify_' + name + ' gauge']
+
+        for (labels, value) in samples:
+            label_text = ','.join(k + '="' + escape(v) + '"' for (k, v) in labels)
+            lines.append('pathify_' + name + ('{' + label_text + '}' if label_text else '') + ' ' + repr(float(value)))
+
+        return '\n'.join(lines) + '\n'
+
+    content = metric('last_run_timestamp_seconds', 'When pathify last ran.',
+            [([('command', stats['command'])], stats['timestamp'])])
+    content += metric('record_entries', 'Number of recorded pathified files.',
+            [([('destination', k)], v) for (k, v) in sorted(stats['entries'].items())])
+    content += metric('record_size_bytes', 'Size of the record file.',
+            [([], stats.get('record_size_bytes', 0))])
+    content += metric('record_load_seconds', 'Time taken to load the record file.',
+            [([], stats.get('record_load_seconds', 0))])
+
+    if stats['scan_seconds']:
+        content += metric('scan_seconds', 'Time taken to scan each destination for changes.',
+                [([('destination', k)], v) for (k, v) in sorted(stats['scan_seconds'].items())])
+        content += metric('update_seconds', 'Time taken to update the record.',
+                [([], stats['update_seconds'])])
+
+    if 'expired_seconds' in stats:
+        content += metric('expired_seconds', 'Time taken to check for invalid files.',
+                [([], stats['expired_seconds'])])
+
+    if 'changes' in stats:
+        content += metric('record_changes', 'Files added, removed or found invalid by the last update.',
+                [([('change', k)], v) for (k, v) in sorted(stats['changes'].items())])
+
+    return content
+
+# Writes a pathified file for `target_path` into `dest_folder` without any prompts,
+# and returns its RecordEntry. The record itself is left for the caller to update.
+def make_shim(target_path, dest_folder, filename=None, interpreter='', overwrite=False):
+    target_path = os.path.abspath(target_path)
+    dest_folder = os.path.abspath(dest_folder)
+
+    if not os.path.isfile(target_path):
+        raise FileNotFoundError('Target path "' + target_path + '" does not exist.')
+    if not os.path.isdir(dest_folder):
+        raise FileNotFoundError('Destination folder "' + dest_folder + '" does not exist.')
+
+    if filename is None:
+        filename = os.path.splitext(os.path.basename(target_path))[0]
+
+    dest_path = os.path.join(dest_folder, filename + template_filetype)
+
+    if not overwrite and os.path.exists(dest_path):
+        raise FileExistsError('File "' + dest_path + '" already exists.')
+
+    utils.write_file_atomic(dest_path, render_template(target_path, interpreter))
+
+    info = make_record_info(target_path)
+    info.update({
+        'interpreter': interpreter,
+        'template': get_template_hash(template_filetype),
+        'shim': get_shim_fingerprint(dest_path)
+    })
+
+    return RecordEntry(dest_folder, filename + template_filetype, target_path, info)
+
+# Every pathified file is checked against the template, so the template text,
+# its hash and the patterns built from it are only worked out once per run.
+# Keyed by (kind, filetype).
+template_cache = {}
+
+def get_template_hash(filetype):
+    if ('hash', filetype) not in template_cache:
+        template_cache[('hash', filetype)] = hashlib.sha1(get_template(filetype).encode('utf-8')).hexdigest()
+
+    return template_cache[('hash', filetype)]
+
+# Read in template file and insert target path and interpreter
+def render_template(target_path, interpreter=''):
+    template = get_template(template_filetype)
+    template = template.replace(template_replace_string['target'], target_path)
+    template = template.replace(template_replace_string['interpreter'], interpreter + (' ' if interpreter else ''))
 
     return template
 
+# Returns a regex matching the line of a pathified file that holds its target.
+# Group 1 is the text leading up to the target, group 2 is the target itself.
+def get_target_pattern(filetype):
+    if ('target', filetype) not in template_cache:
+        template = get_template(filetype)
+
+        # Get the text around the directory in the template, and use this
+        # to reverse-engineer the template.
+        (leader, trailer) = re.search(r"^(.*)<DIRECTORY>(.*)$", template, re.MULTILINE).group(1, 2)
+        pattern = re.compile(r"^(" + re.escape(leader) + r")(.+)" + re.escape(trailer) + r"$", re.MULTILINE)
+        template_cache[('target', filetype)] = pattern
+
+    return template_cache[('target', filetype)]
+
+# Like get_target_pattern(), but for the line holding the interpreter. Group 2
+# is the interpreter, including its trailing space.
+def get_interpreter_pattern(filetype):
+    if ('interpreter', filetype) not in template_cache:
+        template = get_template(filetype)
+        placeholder = template_replace_string['interpreter']
+
+        line = re.search(r"^.*" + re.escape(placeholder) + r".*$", template, re.MULTILINE).group(0)
+        (before, after) = line.split(placeholder, 1)
+
+        # The target may appear on the same line.
+        after = re.escape(after).replace(re.escape(template_replace_string['target']), r".+")
+        pattern = re.compile(r"^(" + re.escape(before) + r")(.*?)" + after + r"$", re.MULTILINE)
+        template_cache[('interpreter', filetype)] = pattern
+
+    return template_cache[('interpreter', filetype)]
+
+# Fallbacks for files generated from an older template, which the patterns
+# above may no longer match. These only rely on the `actualfile` variable that
+# every template has used, with group 2 again holding the target or interpreter.
+loose_target_pattern = re.compile(r"^(\s*(?:set|let)\s+\"?actualfile=['\"]?)(.+?)['\"]?\s*$", re.MULTILINE)
+loose_interpreter_pattern = re.compile(r"^(\s*(?:exec\s+)?)(.*?)\s*[\"']?(?:%actualfile%|\$\{?actualfile\b)", re.MULTILINE)
+
+# Returns the match for the target of a pathified file, or None.
+def find_shim_target(content, filetype):
+    return get_target_pattern(filetype).search(content) or loose_target_pattern.search(content)
+
+# Returns the interpreter of a pathified file ('' if it has none), or None.
+def find_shim_interpreter(content, filetype):
+    match = get_interpreter_pattern(filetype).search(content) or loose_interpreter_pattern.search(content)
+    return match.group(2).strip() if match else None
+
+# Points an existing pathified file at a new target, leaving the rest of it untouched.
+# Returns False, without writing anything, if the target line can't be found.
+# Raises OSError if the file can't be read.
+def retarget_file(path, source):
+    with open(path, 'r') as f:
+        content = f.read()
+
+    match = find_shim_target(content, os.path.splitext(path)[1])
+
+    if not match:
+        return False
+
+    utils.write_file_atomic(path, content[:match.start(2)] + source + content[match.end(2):])
+
+    return True
+
+def get_template(filetype):
+    if ('template', filetype) not in template_cache:
+        with open(template_path, 'r') as f:
+            template_cache[('template', filetype)] = get_template_watermark(template_filetype) + f.read()
+
+    return template_cache[('template', filetype)]
+
 def get_template_watermark(filetype):
     if filetype == '.bat':
         leader = '@echo off\n' + 'rem'
@@ -713,6 +1518,30 @@ record_parser.add_argument('--ls', dest='ls', action='store_true')
 record_parser.add_argument('-u', '--update', dest='update', action='store_true')
 record_parser.set_defaults(func=cmd_record)
 
+# The repair command
+repair_parser = subparsers.add_parser('repair', add_help=False, formatter_class=MinimalFormatter)
+repair_parser.set_defaults(func=cmd_repair)
+
+# The retarget command
+retarget_parser = subparsers.add_parser('retarget', add_help=False, formatter_class=MinimalFormatter)
+retarget_parser.add_argument('old_prefix', type=str)
+retarget_parser.add_argument('new_prefix', type=str)
+retarget_parser.add_argument('--dry-run', dest='dry_run', action='store_true')
+retarget_parser.set_defaults(func=cmd_retarget)
+
+# The mirror command
+mirror_parser = subparsers.add_parser('mirror', add_help=False, formatter_class=MinimalFormatter)
+mirror_parser.add_argument('--from', dest='shared', type=str)
+mirror_parser.add_argument('--to', dest='local', type=str)
+mirror_parser.add_argument('--stop', dest='stop', action='store_true')
+mirror_parser.set_defaults(func=cmd_mirror)
+
+# The regenerate command
+regenerate_parser = subparsers.add_parser('regenerate', add_help=False, formatter_class=MinimalFormatter)
+regenerate_parser.add_argument('--stale', dest='stale', action='store_true')
+regenerate_parser.add_argument('--default-interpreter', dest='default_interpreter', action='store_true')
+regenerate_parser.set_defaults(func=cmd_regenerate)
+
 # The help command
 help_parser = subparsers.add_parser('help', add_help=False, formatter_class=MinimalFormatter)
 help_parser.add_argument('helpfile', type=str, nargs='?')
@@ -722,9 +1551,15 @@ help_parser.set_defaults(func=cmd_help)
 # Run pathify
 # ================================
 
-args = parser.parse_args()
+if __name__ == '__main__':
+    # Shell completion reads from this, so make sure it exists.
+    if not os.path.exists(completion_path):
+        write_completion_cache(get_record())
+
+    args = parser.parse_args()
 
-if args.cmd is None:
-    cmd_help()
-else:
-    args.func(args)
+    if args.cmd is None:
+        cmd_help()
+    else:
+        args.func(args)
+        write_metrics(args.cmd)
@@ -0,0 +1,144 @@
+# --------------------------------------------------------
+# An asyncio interface to pathify, for services that can't
+# afford to block their event loop on filesystem calls.
+#
+# Blocking work runs in an executor, at most `concurrency`
+# calls at a time. Results are yielded as async iterators
+# in completion order, so one slow destination doesn't hold
+# up the others. Changes to the record are committed once,
+# when an iterator finishes. Closing or cancelling it cancels
+# any calls that haven't started yet.
+# --------------------------------------------------------
+
+import asyncio
+import functools
+import os
+from collections import namedtuple
+
+import pathify
+
+
+# A single request for do_many(). Omitting name uses the target's own name.
+ShimRequest = namedtuple('ShimRequest', ['target', 'destination', 'name', 'interpreter', 'overwrite'],
+        defaults=(None, '', False))
+
+# What scan() yields for each destination.
+ScanResult = namedtuple('ScanResult', ['destination', 'added', 'deleted'])
+
+
+class AsyncPathify:
+    def __init__(self, concurrency=4, executor=None):
+        """ `executor` defaults to the event loop's default executor """
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._executor = executor
+
+    async def _run(self, func, *args):
+        """ Run a blocking call in the executor, respecting the concurrency limit """
+        async with self._semaphore:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, functools.partial(func, *args))
+
+    async def _commit(self, added, deleted, updated=[]):
+        """ Commit record changes in the executor. Shielded, so that cancelling the caller can't lose them """
+        if not (added or deleted or updated):
+            return
+
+        loop = asyncio.get_running_loop()
+        commit = functools.partial(pathify.commit_record_changes, added, deleted, updated)
+        await asyncio.shield(loop.run_in_executor(self._executor, commit))
+
+    async def _stream(self, calls):
+        """ Start every (func, args...) call and yield (call, result) pairs as they finish """
+        tasks = {asyncio.ensure_future(self._run(*call)): call for call in calls}
+
+        try:
+            pending = set(tasks)
+
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+
+                for task in done:
+                    yield (tasks[task], task.result())
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def scan(self):
+        """ Update the record like `pathify record -u`, yielding a ScanResult per destination """
+        records = await self._run(pathify.get_record)
+        destinations = pathify.get_tracked_folders(records)
+
+        calls = [(pathify.scan_destination, destination, records.get(destination, {})) for destination in destinations]
+        changes = ([], [], [])
+
+        # Like update_record(), the results of every destination are committed
+        # together at the end, including when cancelled part way through.
+        try:
+            async for (call, result) in self._stream(calls):
+                for (collected, found) in zip(changes, result):
+                    collected.extend(found)
+
+                yield ScanResult(call[1], result[0], result[1])
+        finally:
+            await self._commit(*changes)
+
+    async def expired(self):
+        """ Yield a RecordEntry for every pathified file whose target no longer exists """
+        records = await self._run(pathify.get_record)
+        calls = [(pathify.get_expired_entries, destination, contents) for (destination, contents) in records.items()]
+
+        async for (call, entries) in self._stream(calls):
+            for entry in entries:
+                yield entry
+
+    async def do_many(self, requests):
+        """ Pathify each ShimRequest without prompting, yielding (request, RecordEntry or exception) """
+        requests = [ShimRequest(*request) if isinstance(request, tuple) else ShimRequest(**request) for request in requests]
+        calls = [(self._do, request) for request in requests]
+        created = []
+
+        # The record is committed once at the end, including when cancelled part way through.
+        try:
+            async for (call, result) in self._stream(calls):
+                if not isinstance(result, Exception):
+                    created.append(result)
+
+                yield (call[1], result)
+        finally:
+            await self._commit(created, [])
+
+    def _do(self, request):
+        try:
+            return pathify.make_shim(request.target, request.destination, request.name,
+                    request.interpreter, request.overwrite)
+        except OSError as e:
+            return e
+
+    async def undo_many(self, paths):
+        """ Delete each pathified file in `paths`, yielding (path, RecordEntry or exception) """
+        records = await self._run(pathify.get_record)
+        calls = [(self._undo, os.path.abspath(path), records) for path in paths]
+        removed = []
+
+        try:
+            async for (call, result) in self._stream(calls):
+                if not isinstance(result, Exception):
+                    removed.append(result)
+
+                yield (call[1], result)
+        finally:
+            await self._commit([], removed)
+
+    def _undo(self, path, records):
+        (destination, filename) = os.path.split(path)
+        info = records.get(destination, {}).get(filename)
+
+        if info is None:
+            return LookupError('File "' + path + '" is not a recorded pathified file.')
+
+        try:
+            os.remove(path)
+        except OSError as e:
+            return e
+
+        return pathify.RecordEntry(destination, filename, info['source'], info)
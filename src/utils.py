@@ -4,9 +4,12 @@
 # --------------------------------------------------------
 
 import os
+import re
 import sys
 import stat
+import shutil
 import tempfile
+import time
 
 
 def is_case_sensitive_filesystem():
@@ -83,23 +86,92 @@ def which(program, case_sensitive=_IS_CASE_SENSITIVE_FILESYSTEM):
 
     return None
 
+def build_choice_table(choices, case_insensitive=False):
+    """ Expand tuple and list keys into individual keys, without modifying `choices` """
+    table = {}
+    for key, value in choices.items():
+        keys = key if type(key) == tuple or type(key) == list else [key]
+
+        for i in keys:
+            table[i.lower() if case_insensitive else i] = value
+
+    return table
+
+def parse_range(response, limit):
+    """ Return the keys for a response like '3-7', or None if it isn't a range within 1 to limit """
+    match = re.match(r"^\s*(\d+)\s*-\s*(\d+)\s*$", response)
+
+    if not match:
+        return None
+
+    (start, end) = (int(match.group(1)), int(match.group(2)))
+
+    # Check the bounds before expanding, so that a typo can't build a huge list.
+    if not (1 <= start <= limit and 1 <= end <= limit):
+        return None
+    step = 1 if start <= end else -1
+
+    return [str(i) for i in range(start, end + step, step)]
+
+def print_menu(menu, page, page_size, filter_text):
+    """ Print one page of (key, text, group) menu items, returning the number of pages """
+    pages = max(1, (len(menu) + page_size - 1) // page_size)
+    page = min(page, pages - 1)
+    lines = []
+    group = None
+
+    for (key, text, item_group) in menu[page * page_size:(page + 1) * page_size]:
+        if item_group is not None and item_group != group:
+            lines.append('\n' + item_group + ':')
+            group = item_group
+
+        lines.append('  ' + key + ':  ' + text)
+
+    if filter_text:
+        lines.append('\n' + str(len(menu)) + " matches for '" + filter_text + "'.")
+
+    if pages > 1:
+        lines.append('\nPage ' + str(page + 1) + ' of ' + str(pages) + ". Enter '>' or '<' to change pages.")
+
+    if filter_text or pages > 1:
+        lines.append("Enter '/text' to only show matching choices, or '/' to show all of them.")
+
+    print('\n'.join(lines))
+
+    return pages
+
 def prompt(prompt, choices={}, options={}):
     defaultOptions = {
         'case_insensitive': False,
         'restrict_choices': True,
         'catch_interrupt': True,
-        'list_delimiter': None
+        'list_delimiter': None,
+        'menu': None,
+        'page_size': 20
     }
 
     # Merge passed options with defaults.
     options = dict(list(defaultOptions.items()) + list(options.items()))
 
+    # Built once, so that re-prompting after an invalid response is cheap.
+    table = build_choice_table(choices, options['case_insensitive'])
+
+    # The menu is a list of (key, text, group) tuples that is shown a page
+    # at a time below the prompt, and can be narrowed down by typing '/text'.
+    menu = options['menu'] or []
+    shown_menu = menu
+    filter_text = ''
+    page = 0
+
     # Keep requesting input while user responses are invalid
     # User can cancel by sending a keyboard interrupt (CTRL-C on Windows)
     result = None
     while result == None:
         print(prompt)
 
+        if menu:
+            pages = print_menu(shown_menu, page, options['page_size'], filter_text)
+
         try:
             response = input('=> ')
             print() # print an empty line
@@ -109,54 +181,53 @@ def prompt(prompt, choices={}, options={}):
             else:
                 raise
 
-        # Expand the contents of tuple and list keys into individual keys
-        if choices:
-            for key, value in choices.copy().items():
-                if type(key) == tuple or type(key) == list:
-                    choices.pop(key)
-
-                    for i in key:
-                        choices[i] = value
+        # Menu navigation
+        if menu and response in ('>', '<'):
+            page = min(max(page + (1 if response == '>' else -1), 0), pages - 1)
+            continue
+        if menu and response.startswith('/'):
+            filter_text = response[1:].strip()
+            needle = filter_text.lower()
+            shown_menu = [item for item in menu if needle in item[1].lower() or needle in (item[2] or '').lower()]
+            page = 0
+            continue
 
-        # Make input and option keys case-insensitive
+        # Make input case-insensitive. The choice table already is.
         if options['case_insensitive']:
             response = response.lower()
 
-            for key, value in choices.copy().items():
-                del choices[key]
-                choices[key.lower()] = value
+        # Parse response as a list if it uses the delimiter, expanding any
+        # ranges such as '1-5'. Without a delimiter, a range may only
+        # cover a single choice. Free-text prompts are left as they are.
+        def expand(response):
+            return (table and parse_range(response, len(table))) or [response]
 
-        # Parse response as a list if it uses the delimiter
-        # If invalid and 'restrict_choices' is set, prompt again.
         if options['list_delimiter'] is not None:
-            response_list = response.split(options['list_delimiter'])
-            invalid_choice = False
-            result = []
-
-            # Here we build a list of results based on the parsed response.
-            # If any of the choices are invalid, break the loop and re-prompt.
-            # This is a more complicated version of the single-argument case below.
-            for response in response_list:
-                if response in choices.keys():
-                    result.append(choices[response])
-                elif choices and options['restrict_choices']:
-                    print("Response '" + response + "' is not a valid choice.")
-                    invalid_choice = True
-                    result = None
-                    break
-                else:
-                    result.append(response)
-
-            if invalid_choice:
-                continue
+            response_list = []
+            for response in response.split(options['list_delimiter']):
+                response_list.extend(expand(response))
         else:
-            if response in choices.keys():
-                result = choices[response]
-            elif choices and options['restrict_choices']:
-                print("Response '" + response + "' is not a valid choice.")
+            response_list = expand(response)
+
+            if len(response_list) > 1:
+                print("Response '" + response + "' is not a valid choice. Only one choice may be selected.")
                 continue
+
+        # Here we build a list of results based on the parsed response.
+        # If any of the choices are invalid and 'restrict_choices' is set, re-prompt.
+        result = []
+        for response in response_list:
+            if response in table.keys():
+                result.append(table[response])
+            elif table and options['restrict_choices']:
+                print("Response '" + response + "' is not a valid choice.")
+                result = None
+                break
             else:
-                result = response
+                result.append(response)
+
+        if result is not None and options['list_delimiter'] is None:
+            result = result[0]
 
     # Let the user know they cancelled successfully.
     if result == None:
@@ -164,3 +235,38 @@ def prompt(prompt, choices={}, options={}):
 
     return result
 
+def write_file_atomic(path, content):
+    """ Write content to path so that readers see either the old file or the new one, never a partial write """
+    directory = os.path.dirname(os.path.abspath(path))
+    tmphandle, tmppath = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(path) + '.')
+
+    try:
+        with os.fdopen(tmphandle, 'wb' if isinstance(content, bytes) else 'w') as f:
+            f.write(content)
+
+        # mkstemp creates files readable only by the owner, so give new files
+        # the permissions a plain open() would have.
+        if os.path.exists(path):
+            shutil.copymode(path, tmppath)
+        else:
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(tmppath, 0o666 & ~umask)
+
+        replace_file(tmppath, path)
+    except BaseException:
+        os.remove(tmppath)
+        raise
+
+def replace_file(source, destination, attempts=10, delay=0.01):
+    """ os.replace(), retrying while another process has destination open on Windows """
+    for attempt in range(attempts):
+        try:
+            os.replace(source, destination)
+            return
+        except PermissionError:
+            if attempt == attempts - 1:
+                raise
+
+            time.sleep(delay)
+            delay *= 2